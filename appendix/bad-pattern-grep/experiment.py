@@ -19,46 +19,72 @@ Look for problematic patterns like calls to eval and assignments
 to innerHTML that often lead to XSS when not consistently guarded.
 """
 
+from __future__ import print_function
+
+import py_common.budget
 import py_common.npm
+import py_common.sampling
 import re
 import sys
 
-_LEFT_BOUNDARY = r'(?<![.$_\w])'
-_RIGHT_BOUNDARY = r'(?![.$_\w])'
+# Source files are read as bytes so these are bytes patterns.
+_LEFT_BOUNDARY = br'(?<![.$_\w])'
+_RIGHT_BOUNDARY = br'(?![.$_\w])'
 
 _PATTERNS = (
     ('eval',
-     re.compile(_LEFT_BOUNDARY + r'eval' + _RIGHT_BOUNDARY)),
+     re.compile(_LEFT_BOUNDARY + br'eval' + _RIGHT_BOUNDARY)),
     ('Function constructor',
-     re.compile(_LEFT_BOUNDARY + 'new\s*Function' + _RIGHT_BOUNDARY)),
+     re.compile(_LEFT_BOUNDARY + br'new\s*Function' + _RIGHT_BOUNDARY)),
     ('innerHTML assignment',
-     re.compile('[.]\s*(inner|outer)HTML\s*=')),
+     re.compile(br'[.]\s*(inner|outer)HTML\s*=')),
     ('URL property assignment',
-     re.compile('[.]\s*(src|href)\s*=')),
+     re.compile(br'[.]\s*(src|href)\s*=')),
 )
 
-def find_violations(node_modules, module_name):
+def find_violations(node_modules, module_name, budget=None,
+                    package_lock=None):
+    """
+    Returns [rule_name, ...] with one entry per match.
+
+    Files skipped because they exceed budget have one entry
+    py_common.budget.SKIPPED.
+    """
     violations = []
-    js_srcs = py_common.npm.js_srcs_almost_worst_case(node_modules, module_name)
+    js_srcs = py_common.npm.js_srcs_almost_worst_case(
+        node_modules, module_name, package_lock=package_lock)
+    patterns = tuple(pattern for (_, pattern) in _PATTERNS)
     for (_, js_path) in js_srcs:
-        content = py_common.npm.preprocess_js_content(file(js_path, 'r').read())
-        for (rule_name, pattern) in _PATTERNS:
-            for _ in pattern.finditer(content):
-                violations.append(rule_name)
+        if budget is None:
+            counts = py_common.npm.count_matches(js_path, patterns)
+        else:
+            (ok, counts) = budget.call(
+                js_path, py_common.npm.count_matches, patterns)
+            if not ok:
+                violations.append(py_common.budget.SKIPPED)
+                continue
+        for ((rule_name, _), count) in zip(_PATTERNS, counts):
+            violations.extend([rule_name] * count)
     return violations
 
 
 if __name__ == '__main__':
-    (node_modules, separate_modules, top100_txt) = sys.argv[1:]
+    (argv, budget) = py_common.budget.parse_argv(sys.argv[1:])
+    (argv, package_lock) = py_common.npm.parse_argv(argv)
+    (argv, sample) = py_common.sampling.parse_argv(argv)
+    (node_modules, separate_modules, top100_txt) = argv
 
-    top100 = [x for x in file(top100_txt).read().split('\n') if x]
+    top100 = [x for x in open(top100_txt).read().split('\n') if x]
 
     # Maps rule identifiers to sets of offending modules.
     rule_violations = {}
 
     module_count = 0
-    for module_name in top100:
-        violations = find_violations(node_modules, module_name)
+    for module_name in (sample.shuffled(top100) if sample else top100):
+        budget.start_module(module_name)
+        violations = find_violations(
+            node_modules, module_name, budget=budget,
+            package_lock=package_lock)
         if 'Parse error' in violations or 'Argument list too long' in violations:
             pass
         else:
@@ -69,39 +95,54 @@ if __name__ == '__main__':
             else:
                 vmap = rule_violations[v] = {}
             vmap[module_name] = vmap.get(module_name, 0) + 1
+        if sample and sample.converged(*[
+                (len(rule_violations.get(rule_name, ())), module_count)
+                for (rule_name, _) in _PATTERNS]):
+            break
+    budget.close()
 
     # TODO: exclude Parse error and Argument list too long
 
-    print "## Grepping for Problems {#grep-problems}"
-    print ""
-    print "JS Conformance uses sophisticated type reasoning to find"
-    print "problems in JavaScript code"
-    print "(see [JS Conformance experiment](#jsconf))."
-    print "It may not find problems in code that lacks type hints"
-    print "or that does not parse."
-    print ""
-    print "Grep can be used to reliably find some subset of problems that"
-    print "JS Conformance can identify."
-    print ""
-    print "If grep finds more of the kinds of problems that it can find"
-    print "than JS Conformance, then the code cannot be effectively vetted"
-    print "by code quality tools like JS Conformance."
-    print ""
-    print "| Violation | Count of Modules | Total Count | Quartiles |"
-    print "| --------- | ---------------- | ----------- | --------- |"
+    print("## Grepping for Problems {#grep-problems}")
+    print("")
+    print("JS Conformance uses sophisticated type reasoning to find")
+    print("problems in JavaScript code")
+    print("(see [JS Conformance experiment](#jsconf)).")
+    print("It may not find problems in code that lacks type hints")
+    print("or that does not parse.")
+    print("")
+    print("Grep can be used to reliably find some subset of problems that")
+    print("JS Conformance can identify.")
+    print("")
+    print("If grep finds more of the kinds of problems that it can find")
+    print("than JS Conformance, then the code cannot be effectively vetted")
+    print("by code quality tools like JS Conformance.")
+    print("")
+    if sample is not None:
+        print(sample.describe(module_count, len(top100)))
+        print("")
+    print("| Violation | Count of Modules | Total Count | Quartiles |")
+    print("| --------- | ---------------- | ----------- | --------- |")
     for (v, vmap) in sorted(rule_violations.items()):
         count = 0
         total_count = 0
-        values = vmap.values()
+        values = list(vmap.values())
         for n in values:
             count += 1
             total_count += n
         values += [0] * (module_count - count)
         values.sort()
-        quartiles = '%d / %d / %d' % (
-            values[len(values) >> 2],
-            values[len(values) >> 1],
-            values[(len(values) * 3) >> 2],
-        )
-        print "| `%s` | %d | %d | %s |" % (
-            v, count, total_count, quartiles)
+        if sample is None:
+            module_text = '%d' % count
+            quartiles = '%d / %d / %d' % (
+                values[len(values) >> 2],
+                values[len(values) >> 1],
+                values[(len(values) * 3) >> 2],
+            )
+        else:
+            module_text = '%1.02f%% %s' % (
+                (100.0 * count) / module_count,
+                sample.percentage_interval_text(count, module_count))
+            quartiles = sample.quartiles_text(values)
+        print("| `%s` | %s | %d | %s |" % (
+            v, module_text, total_count, quartiles))
@@ -18,9 +18,13 @@ Runs JSConformance on each of the top 100 modules and collates the results.
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
+
 import json
 import os.path
+import py_common.budget
 import py_common.npm
+import py_common.sampling
 import re
 import shutil
 import subprocess
@@ -38,13 +42,18 @@ _simplifier_res = (
 )
 
 
-def run_jsconf(node_modules, module_name, externs):
+def run_jsconf(node_modules, module_name, externs, budget=None,
+               package_lock=None):
     """
     Runs JSConformance on the given module's source files.
+
+    If the sources or the compiler run exceed budget, then the sole
+    violation is py_common.budget.SKIPPED.
     """
     srcs = py_common.npm.js_srcs_almost_worst_case(
         node_modules, module_name,
-        module_filter=py_common.npm.ignore_tools_that_can_run_early(module_name))
+        module_filter=py_common.npm.ignore_tools_that_can_run_early(module_name),
+        package_lock=package_lock)
     if not srcs:
         raise Exception(module_name + ' has no srcs')
     args = [
@@ -74,9 +83,17 @@ def run_jsconf(node_modules, module_name, externs):
     #print >>sys.stderr, len(' '.join(args))
     if len(' '.join(args)) >= 240000:  # `getconf ARG_MAX` for Mac OSX
         return ['Argument list too long']
-    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    content = process.stdout.read()
-    retcode = process.wait()
+    if budget is None:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        content = process.stdout.read()
+        retcode = process.wait()
+    else:
+        result = budget.run_compiler(args, [js_file for (_, js_file) in srcs])
+        if result is None:
+            return [py_common.budget.SKIPPED]
+        (content, retcode) = result
+    # Compiler output is the only text that needs decoding.
+    content = content.decode('utf-8', 'replace')
     violations = []
     if retcode == 0:
         violations.append('Passed')
@@ -90,9 +107,14 @@ def run_jsconf(node_modules, module_name, externs):
     return violations
 
 if __name__ == '__main__':
-    (node_modules, separate_modules, top100_txt) = sys.argv[1:]
+    (argv, budget) = py_common.budget.parse_argv(sys.argv[1:])
+    (argv, package_lock) = py_common.npm.parse_argv(argv)
+    # Accepted for uniformity with the other experiments but every
+    # module is compiled.
+    (argv, _) = py_common.sampling.parse_argv(argv)
+    (node_modules, separate_modules, top100_txt) = argv
 
-    top100 = [x for x in file(top100_txt).read().split('\n') if x]
+    top100 = [x for x in open(top100_txt).read().split('\n') if x]
 
     externs = set()
     for externs_file in py_common.npm.js_files_under(
@@ -107,9 +129,12 @@ if __name__ == '__main__':
 
     module_count = 0
     for module_name in top100:
-        violations = run_jsconf(node_modules, module_name, externs)
+        budget.start_module(module_name)
+        violations = run_jsconf(
+            node_modules, module_name, externs, budget, package_lock)
         if ('Parse error.' in violations
-            or 'Argument list too long' in violations):
+            or 'Argument list too long' in violations
+            or py_common.budget.SKIPPED in violations):
             pass
         else:
             module_count += 1
@@ -122,25 +147,25 @@ if __name__ == '__main__':
 
     # TODO: exclude Parse error and Argument list too long
 
-    print "## JS Conformance {#jsconf}"
-    print ""
-    print "JS Conformance identifies uses of risky APIs."
-    print ""
-    print "Some modules did not parse.  This may be dues to typescript."
-    print "JSCompiler doesn't deal well with mixed JavaScript and TypeScript"
-    print "inputs."
-    print ""
-    print "If a module is both in the top 100 and is a dependency of another"
-    print "module in the top 100, then it will be multiply counted."
-    print ""
-    print "Out of %d modules that parsed" % module_count
-    print ""
-    print "| Violation | Count of Modules | Total Count | Quartiles |"
-    print "| --------- | ---------------- | ----------- | --------- |"
+    print("## JS Conformance {#jsconf}")
+    print("")
+    print("JS Conformance identifies uses of risky APIs.")
+    print("")
+    print("Some modules did not parse.  This may be dues to typescript.")
+    print("JSCompiler doesn't deal well with mixed JavaScript and TypeScript")
+    print("inputs.")
+    print("")
+    print("If a module is both in the top 100 and is a dependency of another")
+    print("module in the top 100, then it will be multiply counted.")
+    print("")
+    print("Out of %d modules that parsed" % module_count)
+    print("")
+    print("| Violation | Count of Modules | Total Count | Quartiles |")
+    print("| --------- | ---------------- | ----------- | --------- |")
     for (v, vmap) in sorted(rule_violations.items()):
         count = 0
         total_count = 0
-        values = vmap.values()
+        values = list(vmap.values())
         for n in values:
             count += 1
             total_count += n
@@ -151,5 +176,5 @@ if __name__ == '__main__':
             values[len(values) >> 1],
             values[(len(values) * 3) >> 2],
         )
-        print "| `%s` | %d | %d | %s |" % (
-            v, count, total_count, quartiles)
+        print("| `%s` | %d | %d | %s |" % (
+            v, count, total_count, quartiles))
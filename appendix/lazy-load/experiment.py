@@ -24,35 +24,57 @@ Patterns to identify include
 
 import json
 import os.path
+import py_common.budget
 import py_common.npm
+import py_common.sampling
 import re
 import shutil
 import sys
 
 
 lazy_load_pattern = re.compile(
-    r'[{][^}]*(?<![_$\w.])require\s*\(')
+    br'[{][^}]*(?<![_$\w.])require\s*\(')
 
-def find_lazy_load(node_modules, module_name):
+def find_lazy_load(node_modules, module_name, budget=None,
+                   package_lock=None):
     return py_common.npm.js_srcs_matching(
         node_modules, module_name, lazy_load_pattern,
-        module_filter=py_common.npm.ignore_tools_that_can_run_early(module_name))
+        module_filter=py_common.npm.ignore_tools_that_can_run_early(module_name),
+        budget=budget, package_lock=package_lock)
 
 
 if __name__ == '__main__':
-    (node_modules, separate_modules, top100_txt) = sys.argv[1:]
+    (argv, budget) = py_common.budget.parse_argv(sys.argv[1:])
+    (argv, package_lock) = py_common.npm.parse_argv(argv)
+    (argv, sample) = py_common.sampling.parse_argv(argv)
+    (node_modules, separate_modules, top100_txt) = argv
 
-    top100 = [x for x in file(top100_txt).read().split('\n') if x]
+    top100 = [x for x in open(top100_txt).read().split('\n') if x]
 
     uses = 0
     total_count = 0
     has_lazy_load = {}
-    for module_name in top100:
-        js_srcs = find_lazy_load(node_modules, module_name)
+    for module_name in (sample.shuffled(top100) if sample else top100):
+        budget.start_module(module_name)
+        js_srcs = find_lazy_load(
+            node_modules, module_name, budget=budget,
+            package_lock=package_lock)
         has_lazy_load[module_name] = js_srcs
         if len(js_srcs):
             uses += 1
         total_count += 1
+        if sample and sample.converged((uses, total_count)):
+            break
+
+    budget.close()
+
+    interval = ''
+    note = ''
+    if sample is not None:
+        interval = ' ' + sample.percentage_interval_text(uses, total_count)
+        note = '\n\n' + sample.describe(total_count, len(top100))
+    if budget.skipped:
+        note += '\n\n' + budget.summary()
 
     print (
 """
@@ -60,5 +82,5 @@ if __name__ == '__main__':
 
 Lazy loading can complicate code bundling if care is not taken.
 
-%d of %d = %1.02f%% contain a use of require inside a `{...}` block.
-""" % (uses, total_count, (100.0 * uses) / total_count))
+%d of %d = %1.02f%%%s contain a use of require inside a `{...}` block.%s
+""" % (uses, total_count, (100.0 * uses) / total_count, interval, note))
@@ -0,0 +1,90 @@
+# Copyright 2017 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the throughput of the per-file pipeline shared by the grep
+based experiments: read, lex via preprocess_js_content, then match.
+
+Run it under each interpreter to compare them, e.g.
+
+    export PYTHONPATH="$PWD:$PWD/../third_party"
+    python2 -m py_common.benchmark node_modules
+    python3 -m py_common.benchmark node_modules
+
+--text decodes each file as UTF-8 before lexing, as a text based
+pipeline would, for comparison with the default bytes pipeline.
+"""
+
+from __future__ import print_function
+
+import os.path
+import platform
+import re
+import sys
+import time
+
+import py_common.npm
+
+# A mix of the experiments' patterns.
+_PATTERNS = (
+    re.compile(br'(?<![.$_\w])eval(?![.$_\w])'),
+    re.compile(br'[.]\s*(inner|outer)HTML\s*='),
+    re.compile(br'(?<![_$\w.])require\s*\(\s*[^\s)\"\']'),
+)
+_TEXT_PATTERNS = tuple(
+    re.compile(pattern.pattern.decode('ascii')) for pattern in _PATTERNS)
+
+def run_once(paths, decode):
+    """
+    Returns the number of bytes processed.
+    """
+    total_bytes = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            content = f.read()
+        total_bytes += len(content)
+        patterns = _PATTERNS
+        if decode:
+            content = content.decode('utf-8', 'replace')
+            patterns = _TEXT_PATTERNS
+        content = py_common.npm.preprocess_js_content(content)
+        for pattern in patterns:
+            for _ in pattern.finditer(content):
+                pass
+    return total_bytes
+
+if __name__ == '__main__':
+    decode = '--text' in sys.argv[1:]
+    (node_modules,) = [arg for arg in sys.argv[1:] if arg != '--text']
+    paths = sorted(
+        path for path in py_common.npm.js_files_under(node_modules)
+        if os.path.isfile(path))
+
+    # Best of three so that the page cache is warm.
+    best = None
+    total_bytes = 0
+    for _ in range(3):
+        start = time.time()
+        total_bytes = run_once(paths, decode)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print('%s %s, %s mode' % (
+        platform.python_implementation(), platform.python_version(),
+        'text' if decode else 'bytes'))
+    print('%d files, %1.02f MB in %1.02f s' % (
+        len(paths), total_bytes / 1e6, best))
+    print('%1.01f files/s, %1.02f MB/s' % (
+        len(paths) / best, total_bytes / 1e6 / best))
@@ -0,0 +1,276 @@
+# Copyright 2017 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time and size limits so that a single pathological input cannot
+stall an experiment run.
+
+Regular expression matching cannot be interrupted from within the
+matching thread, so per-file work that has a time limit runs in a
+worker process that is killed when it overruns.
+"""
+
+import multiprocessing
+import os
+import os.path
+import subprocess
+import threading
+import time
+import traceback
+
+# How over-budget inputs show up in experiment results.
+SKIPPED = 'skipped: budget'
+
+# Generous enough that none of the top 100 modules' files,
+# including typescript's bundled compiler, hit them.
+_DEFAULTS = {
+    'max-file-bytes': 16 << 20,
+    'max-module-bytes': 256 << 20,
+    'max-file-seconds': 60,
+    'max-module-seconds': 1800,
+    'max-compiler-seconds': 1800,
+}
+
+def parse_argv(argv):
+    """
+    Separates budget flags from an experiment's other arguments.
+
+    Recognizes
+      --max-file-bytes=N        skip larger source files
+      --max-module-bytes=N      skip a module's remaining files after N bytes
+      --max-file-seconds=S      abandon work on one file after S seconds
+      --max-module-seconds=S    skip a module's remaining files after S seconds
+      --max-compiler-seconds=S  kill the Closure Compiler after S seconds
+
+    A value of 0 disables a limit.
+
+    Returns (remaining_args, budget).
+    """
+    remaining = []
+    limits = dict(_DEFAULTS)
+    for arg in argv:
+        (key, _, value) = arg[2:].partition('=')
+        if arg.startswith('--') and key in limits:
+            limits[key] = float(value) or None
+        else:
+            remaining.append(arg)
+    return (remaining, Budget(
+        max_file_bytes=limits['max-file-bytes'],
+        max_module_bytes=limits['max-module-bytes'],
+        max_file_seconds=limits['max-file-seconds'],
+        max_module_seconds=limits['max-module-seconds'],
+        max_compiler_seconds=limits['max-compiler-seconds']))
+
+class Budget(object):
+    """
+    Limits on the work done per file and per module.
+
+    Limits that are None are not enforced.
+    Inputs skipped because they exceed a limit are recorded in
+    skipped as (module_name, path, reason) triples.
+    """
+
+    def __init__(self, max_file_bytes=None, max_file_seconds=None,
+                 max_module_seconds=None, max_compiler_seconds=None,
+                 max_module_bytes=None):
+        self.max_file_bytes = max_file_bytes
+        self.max_module_bytes = max_module_bytes
+        self.max_file_seconds = max_file_seconds
+        self.max_module_seconds = max_module_seconds
+        self.max_compiler_seconds = max_compiler_seconds
+        self.skipped = []
+        self._module_name = None
+        self._module_start = None
+        self._module_bytes = 0
+        self._worker = None
+        # Files that ran out of time once will again under a
+        # different module so are not retried.
+        self._timed_out = set()
+
+    def start_module(self, module_name):
+        """
+        Starts the clock for max_module_seconds and the count for
+        max_module_bytes.
+        """
+        self._module_name = module_name
+        self._module_start = time.time()
+        self._module_bytes = 0
+
+    def call(self, path, f, *args):
+        """
+        Calls f(path, *args) unless path is over budget.
+
+        f must be a module level function so that it can be sent to
+        a worker process, and should return something small.
+
+        Returns (True, result) or (False, None) if path was skipped.
+        """
+        if not self.admit(path):
+            return (False, None)
+        return self.run(path, f, *args)
+
+    def admit(self, path):
+        """
+        False, after recording path as skipped, if reading path would
+        exceed a size limit or the module is out of time.
+
+        Callers that read path themselves should call this first.
+        """
+        if self._module_start is not None and self.max_module_seconds:
+            if time.time() - self._module_start > self.max_module_seconds:
+                self.skip(path, 'module time')
+                return False
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if self.max_file_bytes and size > self.max_file_bytes:
+            self.skip(path, 'bytes')
+            return False
+        if self.max_module_bytes:
+            if self._module_bytes + size > self.max_module_bytes:
+                self.skip(path, 'module bytes')
+                return False
+            self._module_bytes += size
+        return True
+
+    def run(self, path, f, *args):
+        """
+        Like call but without the size checks in admit.
+        """
+        if not self.max_file_seconds:
+            return (True, f(path, *args))
+        if path in self._timed_out:
+            return self.skip(path, 'time')
+        if self._worker is None:
+            self._worker = _Worker()
+        (status, value) = self._worker.call(
+            (f, (path,) + args), self.max_file_seconds)
+        if status == 'timeout':
+            self._worker = None
+            self._timed_out.add(path)
+            return self.skip(path, 'time')
+        elif status == 'crash':
+            self._worker = None
+            return self.skip(path, 'crash')
+        elif status == 'error':
+            raise Exception('%s failed on %s\n%s' % (f.__name__, path, value))
+        return (True, value)
+
+    def run_compiler(self, args, input_paths):
+        """
+        Runs a compiler subprocess, merging stderr into stdout.
+
+        Returns (output, returncode) or None if the inputs exceed
+        max_module_bytes in aggregate or the process runs too long.
+        """
+        if self.max_module_bytes:
+            total_bytes = 0
+            for path in input_paths:
+                try:
+                    total_bytes += os.path.getsize(path)
+                except OSError:
+                    pass
+            if total_bytes > self.max_module_bytes:
+                self.skip(None, 'compiler bytes')
+                return None
+        process = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            process.kill()
+        timer = None
+        if self.max_compiler_seconds:
+            timer = threading.Timer(self.max_compiler_seconds, kill)
+            timer.start()
+        try:
+            output = process.stdout.read()
+            returncode = process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if timed_out:
+            self.skip(None, 'compiler time')
+            return None
+        return (output, returncode)
+
+    def summary(self):
+        """
+        A markdown sentence describing skipped inputs or '' if none.
+        """
+        if not self.skipped:
+            return ''
+        modules = set(module_name for (module_name, _, _) in self.skipped)
+        return '%d inputs from %d modules were %s.' % (
+            len(self.skipped), len(modules), SKIPPED)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+
+    def skip(self, path, reason):
+        """
+        Records path as skipped.  Returns (False, None) as for call.
+        """
+        self.skipped.append((self._module_name, path, reason))
+        return (False, None)
+
+class _Worker(object):
+    """
+    A child process that calls functions on request and that can be
+    killed when a call takes too long.
+    """
+
+    def __init__(self):
+        (self._conn, child_conn) = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(child_conn,))
+        self._process.daemon = True
+        self._process.start()
+        child_conn.close()
+
+    def call(self, request, timeout):
+        """
+        Returns ('ok', result), ('error', traceback_text),
+        ('timeout', None) or ('crash', None) if the worker died, e.g.
+        when killed for running out of memory.  In the last two cases
+        the worker is no longer usable.
+        """
+        self._conn.send(request)
+        if self._conn.poll(timeout):
+            try:
+                return self._conn.recv()
+            except EOFError:
+                self.close()
+                return ('crash', None)
+        self.close()
+        return ('timeout', None)
+
+    def close(self):
+        self._process.terminate()
+        self._process.join()
+        self._conn.close()
+
+def _serve(conn):
+    while True:
+        try:
+            (f, args) = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(('ok', f(*args)))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
@@ -16,6 +16,9 @@ Utilities for mucking with NPM packages
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
+
+import collections
 import json
 import os
 import os.path
@@ -26,6 +29,11 @@ import tempfile
 
 import jslex.jslex
 
+try:
+    _string_types = (basestring,)
+except NameError:  # Python 3
+    _string_types = (str,)
+
 def install_packages(*package):
     """
     Creates a temporary node_modules directory with the given packages
@@ -43,38 +51,187 @@ def install_packages(*package):
 
 def for_each_npm_package(node_modules_dir, f):
     """
-    Calls f with each package directory path.
+    Calls f with each package directory path, including scoped
+    packages and packages nested under other packages' node_modules.
 
     Returns an object with the result of each call keyed by
-    package name.
+    path relative to node_modules_dir.
 
     For a dir tree like
        node_modules
          foo
            package.json
+           node_modules
+             bar
+               package.json
+               ...
            ...
          bar
            package.json
            ...
-         baz
-           package.json
-           ...
+         @org
+           baz
+             package.json
+             ...
          .bin
            ...
     returns
         {
+          '@org/baz': f('node_modules/@org/baz'),
           'bar': f('node_modules/bar'),
-          'baz': f('node_modules/baz'),
-          'foo': f('node_modules/foo')
+          'foo': f('node_modules/foo'),
+          'foo/node_modules/bar': f('node_modules/foo/node_modules/bar'),
         }
     """
     result = {}
-    for fname in os.listdir(node_modules_dir):
-        if fname not in ('.', '..'):
-            if os.path.isfile(os.path.join(node_modules_dir, fname, 'package.json')):
-                result[fname] = f(os.path.join(node_modules_dir, fname))
+    unprocessed = [('', node_modules_dir)]
+    while unprocessed:
+        (prefix, dir_path) = unprocessed.pop()
+        for fname in os.listdir(dir_path):
+            package_dir = os.path.join(dir_path, fname)
+            if fname.startswith('@'):
+                if os.path.isdir(package_dir):
+                    unprocessed.append((prefix + fname + '/', package_dir))
+            elif os.path.isfile(os.path.join(package_dir, 'package.json')):
+                result[prefix + fname] = f(package_dir)
+                nested_dir = os.path.join(package_dir, 'node_modules')
+                if os.path.isdir(nested_dir):
+                    unprocessed.append(
+                        (prefix + fname + '/node_modules/', nested_dir))
     return result
 
+def parse_argv(argv):
+    """
+    Separates --package-lock=PATH from an experiment's other arguments.
+
+    Returns (remaining_args, package_lock) where package_lock is the
+    result of read_package_lock or None when the flag is absent.
+    """
+    remaining = []
+    package_lock = None
+    for arg in argv:
+        if arg.startswith('--package-lock='):
+            package_lock = read_package_lock(arg[len('--package-lock='):])
+        else:
+            remaining.append(arg)
+    return (remaining, package_lock)
+
+def read_package_lock(package_lock_json):
+    """
+    Enumerates installed packages from a package-lock.json file
+    in one read instead of one per package.json.
+
+    Handles lockfileVersion 1, which nests "dependencies", and versions
+    2 and 3, which list "packages" by install path.
+
+    The lockfile should describe the node_modules directory passed to
+    the experiment.  It may be stored elsewhere.
+
+    Returns {
+      'packages': {
+        # Keyed by install path relative to the directory containing
+        # node_modules.
+        'node_modules/@org/foo/node_modules/bar': {
+          'name': 'bar',
+          'version': '1.2.3',
+          'dependencies': { 'baz': '^4.5.6', ... },
+          # None if the lockfile does not say, as for version 1.
+          'has_install_script': False,
+          'dev': False,
+          # Whether only dev dependencies need it when optional ones are
+          # installed.  Always False for version 1.
+          'dev_optional': False,
+          'optional': False,
+        },
+        ...
+      },
+    }
+    """
+    with open(package_lock_json, 'rb') as f:
+        lock = json.loads(f.read().decode('utf-8'))
+    packages = {}
+    if 'packages' in lock:
+        for (install_path, entry) in lock['packages'].items():
+            if not install_path or entry.get('link'):
+                continue  # The root project and symlinked workspaces
+            dependencies = dict(entry.get('optionalDependencies', {}))
+            dependencies.update(entry.get('dependencies', {}))
+            packages[install_path] = {
+                'name': entry.get('name') or _name_from_install_path(install_path),
+                'version': entry.get('version'),
+                'dependencies': dependencies,
+                'has_install_script': bool(entry.get('hasInstallScript')),
+                'dev': bool(entry.get('dev')),
+                'dev_optional': bool(entry.get('devOptional')),
+                'optional': bool(entry.get('optional')),
+            }
+    else:
+        unprocessed = [('', lock.get('dependencies', {}))]
+        while unprocessed:
+            (parent_path, dependencies) = unprocessed.pop()
+            for (name, entry) in dependencies.items():
+                install_path = '%s%snode_modules/%s' % (
+                    parent_path, '/' if parent_path else '', name)
+                packages[install_path] = {
+                    'name': name,
+                    'version': entry.get('version'),
+                    'dependencies': dict(entry.get('requires', {})),
+                    'has_install_script': None,
+                    'dev': bool(entry.get('dev')),
+                    'dev_optional': False,
+                    'optional': bool(entry.get('optional')),
+                }
+                unprocessed.append(
+                    (install_path, entry.get('dependencies', {})))
+    return {
+        'packages': packages,
+    }
+
+def locked_dependency_path(package_lock, install_path, name):
+    """
+    The install path that node would load name from when required by
+    the package at install_path, or None if the lockfile has none.
+
+    Like node's own lookup, this tries node_modules directories under
+    install_path and then its ancestors.
+    """
+    packages = package_lock['packages']
+    path = install_path
+    while True:
+        candidate = '%s%snode_modules/%s' % (path, '/' if path else '', name)
+        if candidate in packages:
+            return candidate
+        if not path:
+            return None
+        # Strip the last node_modules/name or node_modules/@org/name
+        i = path.rfind('node_modules/')
+        path = path[:i].rstrip('/') if i >= 0 else ''
+
+def _name_from_install_path(install_path):
+    return install_path[install_path.rfind('node_modules/') + len('node_modules/'):]
+
+def _locked_install_path(package_lock, project_root, package_root):
+    """
+    The install path of package_root in package_lock or None.
+
+    project_root is the directory containing node_modules and
+    package_root should exist.  Warns once per project_root on a miss
+    since that usually means that the lockfile does not describe the
+    tree.
+    """
+    rel_path = os.path.relpath(package_root, project_root)
+    rel_path = rel_path.replace(os.sep, '/')
+    if rel_path in package_lock['packages']:
+        return rel_path
+    if project_root not in _lock_misses_warned:
+        _lock_misses_warned.add(project_root)
+        print(
+            "Warning: %s is not in --package-lock so its dependencies come"
+            " from package.json.  Does the lockfile describe %s?" % (
+                rel_path, os.path.join(project_root, 'node_modules')),
+            file=sys.stderr)
+    return None
+
 def ignore_tools_that_can_run_early(module_name):
     """
     A module filter that filters out dependencies on modules that
@@ -85,10 +242,62 @@ def ignore_tools_that_can_run_early(module_name):
         mn.startswith('babel')
         or mn.startswith('eslint'))
 
-_REQUIRE_RE = re.compile(r'(?<![\w.])require\s*[(]([^\)]*)')
-_REL_REQUIRE_RE = re.compile(r'^[.][.]?/')
+# Source files are read and matched as bytes.
+_REQUIRE_RE = re.compile(br'(?<![\w.$])require\s*[(]([^\)]*)')
+# import x from 'y', import {x} from 'y', import 'y', export * from 'y', ...
+# are found by _static_import_specifiers in linear time.  A single regex
+# with a lazy clause before "from" backtracks badly on padded input.
+_IMPORT_KEYWORD_RE = re.compile(br'(?<![\w.$])(?:import|export)(?![\w$])')
+_IMPORT_CLAUSE_RE = re.compile(br'[\w$*{},\s]*')
+_STRING_LITERAL_RE = re.compile(
+    br'"(?:[^"\\\n]|\\.)*"' br"|'(?:[^'\\\n]|\\.)*'")
+_WORD_CHAR_RE = re.compile(br'[\w$]')
+_DYNAMIC_IMPORT_RE = re.compile(br'(?<![\w.$])import\s*[(]([^\)]*)')
+_REL_REQUIRE_RE = re.compile(r'^(?:[.][.]?(?:/|$)|/)')
+
+# Modules that are provided by node itself so do not resolve to files.
+# Subpaths are listed separately since node only treats these exact
+# specifiers as builtin.  Others, like the common 'string_decoder/' or
+# 'process/browser', load the npm package of the same name.
+_NODE_BUILTINS = frozenset((
+    'assert', 'assert/strict', 'async_hooks', 'buffer', 'child_process',
+    'cluster', 'console', 'constants', 'crypto', 'dgram',
+    'diagnostics_channel', 'dns', 'dns/promises', 'domain', 'events', 'fs',
+    'fs/promises', 'http', 'http2', 'https', 'inspector',
+    'inspector/promises', 'module', 'net', 'os', 'path', 'path/posix',
+    'path/win32', 'perf_hooks', 'process', 'punycode', 'querystring',
+    'readline', 'readline/promises', 'repl', 'stream', 'stream/consumers',
+    'stream/promises', 'stream/web', 'string_decoder', 'sys', 'timers',
+    'timers/promises', 'tls', 'trace_events', 'tty', 'url', 'util',
+    'util/types', 'v8', 'vm', 'wasi', 'worker_threads', 'zlib',
+))
 
-def js_srcs_almost_worst_case(node_modules, module_name, module_filter=None):
+# The extensions that node tries, in order, when a require does not
+# name a file outright.
+_FILE_EXTENSIONS = ('.js', '.json', '.node')
+# Loaded files that are JS source.  Other files, like .json, .node or
+# a stylesheet loaded via a bundler, cannot require or import anything
+# and are not passed to the experiments.
+_JS_SRC_EXTENSIONS = ('.js', '.mjs', '.cjs', '.ts')
+
+# Export conditions that node matches against package.json "exports"
+# and "imports" keyed by how the module was loaded.
+_CONDITIONS = {
+    'require': frozenset(('node', 'require', 'default')),
+    'import': frozenset(('node', 'import', 'default')),
+}
+
+# Memoized lookups.  These are keyed by absolute paths so are valid
+# across calls with different node_modules directories.
+_package_json_cache = {}
+_resolution_cache = {}
+_file_deps_cache = {}
+
+# Project roots for which _locked_install_path has warned of a miss.
+_lock_misses_warned = set()
+
+def js_srcs_almost_worst_case(node_modules, module_name, module_filter=None,
+                              package_lock=None):
     """
     The set of JS & TS source files required by a module
     including those required by prod dependencies.
@@ -105,48 +314,84 @@ def js_srcs_almost_worst_case(node_modules, module_name, module_filter=None):
     dependencies, so assuming otherwise would not actually
     make us conservative either.
 
+    If package_lock is the result of read_package_lock, then the
+    dependencies of modules that we cannot bound come from it instead
+    of from each module's package.json.
+
     Returns [('module', '/abs/path/to/src.js'), ...]
     """
     if module_filter is None:
         module_filter = lambda _: True
     js_files = set()
-    unprocessed = [module_name]
+    # Entries are (module_name, package_root, entry_points) where
+    # entry_points is None to start from the package's main files.
+    unprocessed = [(module_name, os.path.join(node_modules, module_name), None)]
+    project_root = os.path.dirname(os.path.realpath(node_modules))
     visited = set()
+    visited_srcs = set()
+    worst_case_roots = set()
     while unprocessed:
-        up_module_name = unprocessed.pop()
-        if up_module_name in visited: continue
-        visited.add(up_module_name)
+        (up_module_name, package_root, entry_points) = unprocessed.pop()
+        if package_root is None:
+            package_root = os.path.join(node_modules, up_module_name)
+        package_root = os.path.realpath(package_root)
+        if (package_root, entry_points) in visited: continue
+        visited.add((package_root, entry_points))
+        if package_root in worst_case_roots: continue
         if not module_filter(up_module_name): continue
         rq = None
         try:
-            rq = requires(node_modules, module_name)
+            rq = _package_requires(package_root, entry_points, visited_srcs)
         except:
             import traceback
             traceback.print_exc()
         if rq is not None and rq['upper']:
             js_files.update([(up_module_name, src) for src in rq['srcs']])
-            unprocessed += rq['deps']
+            unprocessed += rq['dep_entries']
         else:
             #print >>sys.stderr, "Falling back to worst-case for %s required by %s" % (
             #    up_module_name, module_name)
+            worst_case_roots.add(package_root)
             js_files.update([(up_module_name, src) for src in
-                             js_files_under(
-                                 os.path.join(node_modules, up_module_name))
+                             js_files_under(package_root)
                              if not probable_non_prod_file(src)])
-            package_json = None
-            try:
-                package_json = json.loads(
-                    file(os.path.join(node_modules, up_module_name, 'package.json'), 'r')
-                    .read())
-            except:
-                print >>sys.stderr, "Undeclared dependency %s" % up_module_name
-            if package_json is not None:
-                unprocessed += package_json['dependencies'].keys()
+            install_path = None
+            # Packages that are not installed, like optional ones, are
+            # expected to be missing from the lockfile too.
+            if package_lock is not None and os.path.isdir(package_root):
+                install_path = _locked_install_path(
+                    package_lock, project_root, package_root)
+            if install_path is not None:
+                locked = package_lock['packages'][install_path]
+                for dep_name in locked['dependencies'].keys():
+                    dep_path = locked_dependency_path(
+                        package_lock, install_path, dep_name)
+                    unprocessed.append(
+                        (dep_name,
+                         os.path.join(project_root, dep_path)
+                         if dep_path is not None else None,
+                         None))
+            else:
+                package_json = _read_package_json(package_root)
+                if package_json is None:
+                    print("Undeclared dependency %s" % up_module_name,
+                          file=sys.stderr)
+                else:
+                    for dep_name in package_json.get('dependencies', {}).keys():
+                        unprocessed.append(
+                            (dep_name,
+                             _find_package_dir(package_root, dep_name),
+                             None))
     return tuple(sorted(js_files))
 
 def requires(node_modules, module_name):
     """
-    Follows require() calls to bound the set of JS files in a module.
+    Follows require() calls and ES module imports to bound the set of
+    JS files in a module.
+
+    Specifiers are resolved the way node resolves them, so this
+    takes into account index.js, package.json "exports" and nested
+    node_modules directories.
 
     Returns {
       'srcs': [...],  # main.js and same-module files required thereof
@@ -154,56 +399,385 @@ def requires(node_modules, module_name):
       'upper': True,  # True when srcs and deps accounts for all require calls.
     }
     """
-    module_root = os.path.join(node_modules, module_name)
-    package_json = json.loads(
-        file(os.path.join(module_root, 'package.json')).read())
-    main_files = package_json.get('main', None)
-    if type(main_files) in (str, unicode):
-        main_files = (main_files,)
-    if not main_files:
-        return { 'srcs': (), 'deps': (), 'upper': False }
+    rq = _package_requires(
+        os.path.realpath(os.path.join(node_modules, module_name)), None, set())
+    return {
+        'srcs': rq['srcs'],
+        'deps': tuple(sorted(set(name for (name, _, _) in rq['dep_entries']))),
+        'upper': rq['upper'],
+    }
+
+def _package_requires(package_root, entry_points, visited):
+    """
+    Follows requires from entry_points, or the package's main files if
+    None, through files under package_root.
+
+    visited is the set of source files already processed which is
+    updated in place.
+
+    Returns {
+      'srcs': [...],         # files under package_root reached
+      'dep_entries': [...],  # (module_name, package_root, entry_points)
+                             # package_root is None when not installed.
+      'upper': True,         # as for requires
+    }
+    """
+    if _read_package_json(package_root) is None:
+        return { 'srcs': (), 'dep_entries': (), 'upper': False }
+    if entry_points is None:
+        entry_points = tuple(sorted(set(
+            entry for entry in (
+                _resolve_package_entry(package_root, kind)
+                for kind in ('require', 'import'))
+            if entry is not None)))
+        if not entry_points:
+            return { 'srcs': (), 'dep_entries': (), 'upper': False }
     srcs = set()
-    deps = set()
+    dep_entries = set()
     upper = True
-    visited = set()
-    unprocessed = [os.path.join(module_root, rp) for rp in main_files]
+    unprocessed = list(entry_points)
     while unprocessed:
-        src = os.path.realpath(unprocessed.pop())
+        src = unprocessed.pop()
         if src in visited: continue
         visited.add(src)
-        if os.path.isdir(src):
-            for f in js_files_under(src):
-                unprocessed.append(f)
-        else:
-            srcs.add(src)
-            content = ''
-            try:
-                content = file(src, 'r').read()
-            except:
-                upper = False
-            for match in _REQUIRE_RE.finditer(content):
-                arg = match.group(1).strip()
-                if not arg:
-                    pass  # Zero arguments
-                elif len(arg) > 2 and arg[0] in ('"', "'") and arg[0] == arg[-1]:
-                    try:
-                        arg = json.loads('"%s"' % arg[1:-1])
-                    except:
-                        #print >>sys.stderr, "Cannot parse require argument %s" % arg
-                        upper = False
-                    if _REL_REQUIRE_RE.match(arg):
-                        if not arg.endswith('.js'): arg += '.js'
-                        unprocessed.append(arg)
-                    else:
-                        deps.add(arg)
-                else:
-                    upper = False
+        if not src.endswith(_JS_SRC_EXTENSIONS): continue
+        srcs.add(src)
+        (edges, src_upper) = _file_deps(src)
+        upper = upper and src_upper
+        for (dep_name, dep_root, dep_src) in edges:
+            if dep_name is None or (dep_src is not None
+                                    and dep_root == package_root):
+                # A relative path or self-reference via the package's name.
+                unprocessed.append(dep_src)
+            else:
+                dep_entries.add((dep_name, dep_root,
+                                 (dep_src,) if dep_src is not None else None))
     return {
         'srcs': tuple(sorted(srcs)),
-        'deps': tuple(sorted(deps)),
-        'upper': upper
+        'dep_entries': tuple(dep_entries),
+        'upper': upper,
     }
 
+def _file_deps(src):
+    """
+    The resolved dependencies of a single source file.
+
+    Returns ([(module_name, package_root, path), ...], upper)
+    where module_name and package_root are None for relative paths,
+    package_root and path are None for modules that are not installed,
+    and upper is False if some load could not be bounded.
+    Builtin modules are omitted.
+    """
+    if src in _file_deps_cache:
+        return _file_deps_cache[src]
+    edges = []
+    upper = True
+    content = b''
+    try:
+        with open(src, 'rb') as src_file:
+            content = src_file.read()
+    except:
+        upper = False
+    specifiers = []
+    for match in _REQUIRE_RE.finditer(content):
+        specifiers.append(('require', match.group(1)))
+    if b'import' in content or b'export' in content:
+        for literal in _static_import_specifiers(content):
+            specifiers.append(('import', literal))
+        for match in _DYNAMIC_IMPORT_RE.finditer(content):
+            specifiers.append(('import', match.group(1)))
+    from_dir = os.path.dirname(src)
+    for (kind, arg) in specifiers:
+        arg = arg.strip()
+        if not arg:
+            continue  # Zero arguments
+        specifier = _string_literal_value(arg)
+        if specifier is None:
+            #print >>sys.stderr, "Cannot parse require argument %s" % arg
+            upper = False
+            continue
+        if specifier.startswith('node:') or specifier in _NODE_BUILTINS:
+            continue
+        path = resolve(from_dir, specifier, kind)
+        if path is None:
+            if _REL_REQUIRE_RE.match(specifier) or specifier.startswith('#'):
+                upper = False
+            else:
+                # Probably an optional or undeclared dependency.
+                # The caller falls back to the worst case for it.
+                name = _split_bare_specifier(specifier)[0]
+                edges.append((name, _find_package_dir(from_dir, name), None))
+        elif _REL_REQUIRE_RE.match(specifier) or specifier.startswith('#'):
+            edges.append((None, None, path))
+        else:
+            name = _split_bare_specifier(specifier)[0]
+            edges.append((name, _find_package_dir(from_dir, name), path))
+    result = (tuple(edges), upper)
+    _file_deps_cache[src] = result
+    return result
+
+def _static_import_specifiers(content):
+    """
+    Yields the string literals that follow "from" in import and export
+    statements, or directly follow import as in import 'x'.
+    """
+    # Every import or export keyword inside one run of clause characters
+    # has a clause ending at the same place, and the same literal after
+    # it, so each run and its literal are scanned once.
+    run_end = -1
+    trimmed_end = -1
+    literal = None
+    for keyword in _IMPORT_KEYWORD_RE.finditer(content):
+        start = keyword.end()
+        if start > run_end:
+            run_end = _IMPORT_CLAUSE_RE.match(content, start).end()
+            trimmed_end = run_end
+            while (trimmed_end > start
+                   and content[trimmed_end - 1:trimmed_end].isspace()):
+                trimmed_end -= 1
+            literal = _STRING_LITERAL_RE.match(content, run_end)
+        if literal is None:
+            continue
+        from_start = trimmed_end - 4
+        if trimmed_end == start or (
+                from_start > start
+                and content[from_start:trimmed_end] == b'from'
+                and not _WORD_CHAR_RE.match(
+                    content[from_start - 1:from_start])):
+            yield literal.group(0)
+
+def _string_literal_value(arg):
+    """
+    The value of a JS string literal or None if arg is not one.
+
+    arg is bytes and the value is decoded as UTF-8.
+    """
+    if len(arg) >= 2 and arg[:1] in (b'"', b"'") and arg[:1] == arg[-1:]:
+        try:
+            return json.loads((b'"' + arg[1:-1] + b'"').decode('utf-8'))
+        except:
+            pass
+    return None
+
+def resolve(from_dir, specifier, kind='require'):
+    """
+    Resolves a module specifier the way node does.
+
+    from_dir is the directory containing the requiring file.
+    kind is 'require' or 'import' and determines which
+    package.json "exports" conditions apply.
+
+    See https://nodejs.org/api/modules.html#all-together
+
+    Returns the real path of the loaded file or None if the
+    specifier does not resolve to a file.
+    """
+    dir_cache = _resolution_cache.get(from_dir)
+    if dir_cache is None:
+        dir_cache = _resolution_cache[from_dir] = {}
+    key = (specifier, kind)
+    if key not in dir_cache:
+        dir_cache[key] = _resolve_uncached(from_dir, specifier, kind)
+    return dir_cache[key]
+
+def _resolve_uncached(from_dir, specifier, kind):
+    if _REL_REQUIRE_RE.match(specifier):
+        target = os.path.join(from_dir, specifier)
+        path = _load_as_file(target) or _load_as_directory(target, kind)
+    elif specifier.startswith('#'):
+        path = _load_package_imports(from_dir, specifier, kind)
+    else:
+        (name, subpath) = _split_bare_specifier(specifier)
+        package_dir = _find_package_dir(from_dir, name)
+        if package_dir is None:
+            return None
+        package_json = _read_package_json(package_dir) or {}
+        if package_json.get('exports') is not None:
+            path = _resolve_exports(
+                package_dir, package_json['exports'], subpath, kind)
+        else:
+            target = os.path.normpath(os.path.join(package_dir, subpath))
+            path = _load_as_file(target) or _load_as_directory(target, kind)
+    if path is not None:
+        path = os.path.realpath(path)
+    return path
+
+def _split_bare_specifier(specifier):
+    """
+    'foo/bar' -> ('foo', './bar'), '@org/foo' -> ('@org/foo', '.')
+    """
+    parts = specifier.split('/')
+    n = 2 if specifier.startswith('@') else 1
+    name = '/'.join(parts[:n])
+    rest = parts[n:]
+    return (name, './' + '/'.join(rest) if rest else '.')
+
+def _find_package_dir(from_dir, name):
+    """
+    The package directory that a bare require of name loads from
+    from_dir by searching node_modules directories in ancestors.
+    """
+    dir_cache = _resolution_cache.get(from_dir)
+    if dir_cache is None:
+        dir_cache = _resolution_cache[from_dir] = {}
+    key = (name, 'package')
+    if key in dir_cache:
+        return dir_cache[key]
+    package_dir = None
+    cur_dir = os.path.abspath(from_dir)
+    while True:
+        if os.path.basename(cur_dir) != 'node_modules':
+            candidate = os.path.join(cur_dir, 'node_modules', name)
+            if os.path.isdir(candidate):
+                package_dir = os.path.realpath(candidate)
+                break
+        parent_dir = os.path.dirname(cur_dir)
+        if parent_dir == cur_dir:
+            break
+        cur_dir = parent_dir
+    dir_cache[key] = package_dir
+    return package_dir
+
+def _read_package_json(package_dir):
+    """
+    The parsed package.json under package_dir or None.
+
+    Object keys are kept in order since "exports" conditions
+    are order-sensitive.
+    """
+    if package_dir not in _package_json_cache:
+        package_json = None
+        try:
+            with open(os.path.join(package_dir, 'package.json'), 'rb') as f:
+                package_json = json.loads(
+                    f.read().decode('utf-8'),
+                    object_pairs_hook=collections.OrderedDict)
+        except:
+            pass
+        if not isinstance(package_json, dict):
+            package_json = None
+        _package_json_cache[package_dir] = package_json
+    return _package_json_cache[package_dir]
+
+def _resolve_package_entry(package_root, kind):
+    """
+    The file loaded when the package at package_root is required
+    or imported by name.
+    """
+    package_json = _read_package_json(package_root) or {}
+    if package_json.get('exports') is not None:
+        return _resolve_exports(
+            package_root, package_json['exports'], '.', kind)
+    return _load_as_directory(package_root, kind)
+
+def _load_as_file(path):
+    if os.path.isfile(path):
+        return path
+    for ext in _FILE_EXTENSIONS:
+        if os.path.isfile(path + ext):
+            return path + ext
+    return None
+
+def _load_index(path):
+    for ext in _FILE_EXTENSIONS:
+        index_path = os.path.join(path, 'index' + ext)
+        if os.path.isfile(index_path):
+            return index_path
+    return None
+
+def _load_as_directory(path, kind):
+    if not os.path.isdir(path):
+        return None
+    package_json = _read_package_json(path)
+    if package_json is not None:
+        main = package_json.get('main', None)
+        if isinstance(main, _string_types) and main:
+            main_path = os.path.join(path, main)
+            found = _load_as_file(main_path) or _load_index(main_path)
+            if found is not None:
+                return found
+    return _load_index(path)
+
+def _resolve_exports(package_dir, exports, subpath, kind):
+    """
+    Resolves subpath, '.' or './...', against a package.json "exports"
+    or "imports" value.
+    """
+    if subpath.startswith('.') and (not isinstance(exports, dict) or not any(
+            key.startswith('.') for key in exports.keys())):
+        # Sugar for { ".": exports }
+        if subpath != '.':
+            return None
+        exports = { '.': exports }
+    if subpath in exports:
+        return _resolve_export_target(
+            package_dir, exports[subpath], kind, None)
+    # Find the most specific pattern like "./lib/*.js" or legacy
+    # directory mapping like "./lib/".
+    best = None
+    for key in exports.keys():
+        star = key.find('*')
+        if star >= 0:
+            (prefix, suffix) = (key[:star], key[star + 1:])
+            if (subpath.startswith(prefix) and subpath.endswith(suffix)
+                and len(subpath) >= len(prefix) + len(suffix)):
+                match = subpath[len(prefix):len(subpath) - len(suffix)]
+                if best is None or len(prefix) > len(best[0]):
+                    best = (prefix, key, match)
+        elif key.endswith('/') and subpath.startswith(key):
+            if best is None or len(key) > len(best[0]):
+                best = (key, key, None)
+    if best is None:
+        return None
+    (prefix, key, match) = best
+    if match is None:
+        target = exports[key]
+        if not isinstance(target, _string_types):
+            return None
+        return _load_as_file(os.path.normpath(os.path.join(
+            package_dir, target, subpath[len(key):])))
+    return _resolve_export_target(package_dir, exports[key], kind, match)
+
+def _resolve_export_target(package_dir, target, kind, pattern_match):
+    if isinstance(target, _string_types):
+        if pattern_match is not None:
+            target = target.replace('*', pattern_match)
+        path = os.path.normpath(os.path.join(package_dir, target))
+        return path if os.path.isfile(path) else None
+    elif isinstance(target, list):
+        for alternative in target:
+            path = _resolve_export_target(
+                package_dir, alternative, kind, pattern_match)
+            if path is not None:
+                return path
+    elif isinstance(target, dict):
+        conditions = _CONDITIONS[kind]
+        for (condition, sub_target) in target.items():
+            if condition in conditions:
+                path = _resolve_export_target(
+                    package_dir, sub_target, kind, pattern_match)
+                if path is not None:
+                    return path
+    return None
+
+def _load_package_imports(from_dir, specifier, kind):
+    """
+    Resolves a '#name' specifier against the "imports" field of the
+    package.json of the closest enclosing package.
+    """
+    cur_dir = os.path.abspath(from_dir)
+    while True:
+        package_json = _read_package_json(cur_dir)
+        if package_json is not None:
+            imports = package_json.get('imports')
+            if not isinstance(imports, dict):
+                return None
+            return _resolve_exports(cur_dir, imports, specifier, kind)
+        parent_dir = os.path.dirname(cur_dir)
+        if parent_dir == cur_dir or os.path.basename(cur_dir) == 'node_modules':
+            return None
+        cur_dir = parent_dir
+
 def js_files_under(root_dir):
     for dir_path, subdir_list, file_list in os.walk(root_dir):
         for f in file_list:
@@ -218,37 +792,112 @@ def preprocess_js_content(content):
     content is upper-cased to make it easier to distinguish
     lower-case keywords and identifiers from similar content that
     appears inside a string literal.
+
+    content may be bytes or text and the result has the same type.
     """
 
     lexer = jslex.jslex.JsLexer()
+    space = b' ' if isinstance(content, bytes) else u' '
     canon_tokens = []
     for (tok_type, tok_content) in lexer.lex(content):
         if tok_type in ('comment', 'linecomment'):
-            tok_content = ' '
+            tok_content = space
         elif tok_type in ('regex', 'string'):
             tok_content = tok_content.upper()
         canon_tokens.append(tok_content)
-    processed_content = ''.join(canon_tokens)
+    processed_content = content[:0].join(canon_tokens)
 
     return processed_content
 
-def js_srcs_matching(node_modules, module_name, pattern, module_filter=None):
+_SKIPPABLE_TOKEN_TYPES = ('ws', 'comment', 'linecomment')
+
+def required_modules(content):
+    """
+    Yields the module specifiers passed as string literals to require
+    calls in JS content.
+
+    Unlike _REQUIRE_RE this works on tokens, so it ignores text in
+    comments and strings and calls like obj.require('x').
+    It is a generator so callers can stop lexing early.
+    """
+    # Index of the next token expected in require ( 'specifier' )
+    state = 0
+    specifier = None
+    prev_significant = None
+    for (tok_type, tok_content) in jslex.jslex.JsLexer().lex(content):
+        if tok_type in _SKIPPABLE_TOKEN_TYPES:
+            continue
+        if state == 1 and tok_content in (b'(', u'('):
+            state = 2
+        elif state == 2 and tok_type == 'string':
+            specifier = tok_content
+            state = 3
+        elif state == 3 and tok_content in (b')', u')'):
+            if isinstance(specifier, bytes):
+                value = _string_literal_value(specifier)
+            else:
+                value = _string_literal_value(specifier.encode('utf-8'))
+            if value is not None:
+                yield value
+            state = 0
+        else:
+            state = 0
+        if (state == 0 and tok_type == 'id'
+            and tok_content in (b'require', u'require')
+            and prev_significant not in (b'.', u'.')):
+            state = 1
+        prev_significant = tok_content
+
+def count_matches(path, patterns, preprocess=True, first_only=False):
+    """
+    The number of matches of each of patterns in the file at path.
+
+    Files are read as bytes so patterns must be bytes patterns.
+
+    If preprocess is true, then matches are against the output of
+    preprocess_js_content.
+    If first_only is true, then stops at the first match so each
+    count is 0 or 1.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    if preprocess:
+        content = preprocess_js_content(content)
+    counts = []
+    for pattern in patterns:
+        if first_only:
+            counts.append(1 if pattern.search(content) else 0)
+        else:
+            counts.append(sum(1 for _ in pattern.finditer(content)))
+    return counts
+
+def js_srcs_matching(node_modules, module_name, pattern, module_filter=None,
+                     budget=None, package_lock=None):
     """
     A list of srcs under root_dir whose content
     matches pattern.
+
+    If budget is a py_common.budget.Budget then srcs that exceed it
+    are skipped.
+    package_lock is as for js_srcs_almost_worst_case.
     """
 
     srcs = js_srcs_almost_worst_case(
         node_modules=node_modules,
         module_name=module_name,
-        module_filter=module_filter)
+        module_filter=module_filter,
+        package_lock=package_lock)
 
     matching_srcs = []
     for src in srcs:
         (_, path) = src
-        canon_content = preprocess_js_content(file(path, 'r').read())
-        match = pattern.search(canon_content)
-        if match:
+        if budget is None:
+            counts = count_matches(path, (pattern,), first_only=True)
+        else:
+            (ok, counts) = budget.call(
+                path, count_matches, (pattern,), True, True)
+            if not ok: continue
+        if counts[0]:
             matching_srcs.append(src)
     return matching_srcs
 
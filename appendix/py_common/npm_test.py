@@ -0,0 +1,164 @@
+# Copyright 2017 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for py_common.npm.  From the appendix directory run
+
+    export PYTHONPATH="$PWD:$PWD/../third_party"
+    python -m unittest py_common.npm_test
+"""
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import py_common.npm
+
+class StaticImportSpecifiersTest(unittest.TestCase):
+
+    def specifiers(self, content):
+        return list(py_common.npm._static_import_specifiers(content))
+
+    def test_forms(self):
+        self.assertEqual(
+            self.specifiers(
+                b"import x from 'a'; import {b, c as d} from \"b\";\n"
+                b"import 'c'; export * from 'd'; import * as ns from 'e';\n"
+                b"export { f,\n  g } from\n  'h'; export default 'i';\n"
+                b"a.import 'j'; var s = 'from'; export * transfrom 'k'"),
+            [b"'a'", b'"b"', b"'c'", b"'d'", b"'e'", b"'h'"])
+
+    def test_padded_input_is_linear(self):
+        # These took seconds to minutes with a regex whose clause
+        # before "from" had overlapping whitespace quantifiers, or
+        # that matched the literal after a run once per keyword.
+        # Each takes milliseconds now so the limit is loose enough
+        # for slow machines.
+        for content in (b'import' + b' ' * 4000 + b'x',
+                        b'export a, ' * 20000,
+                        b'import ' * 20000,
+                        b'import ' * 4000 + b'"' + b'a' * 200000):
+            start = time.time()
+            self.assertEqual(self.specifiers(content), [])
+            self.assertTrue(time.time() - start < 10.0)
+
+class ResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.node_modules = os.path.join(self.root, 'node_modules')
+        self.write('exp/package.json', {
+            'name': 'exp',
+            'exports': {
+                '.': {'import': './esm.mjs', 'require': './cjs.js'},
+                './feat/*': './lib/*.js',
+                './cond': {'default': './d.js', 'node': './n.js'},
+            },
+            'imports': {'#dep': {'node': './lib/dep.js'}},
+        })
+        for name in ('esm.mjs', 'cjs.js', 'd.js', 'n.js', 'lib/x.js',
+                     'lib/dep.js'):
+            self.write('exp/' + name, '')
+        self.write('exp/lib/self.js', "require('exp/feat/x')")
+        self.write('main/package.json', {'name': 'main', 'main': 'lib/main'})
+        self.write('main/lib/main.js', '')
+        self.write('main/lib/other.js', '')
+        self.write('idx/package.json', {'name': 'idx'})
+        self.write('idx/index.js', '')
+        self.write('dep/package.json', {'name': 'dep'})
+        self.write('dep/index.js', '')
+        self.write('outer/package.json', {'name': 'outer'})
+        self.write('outer/index.js',
+                   "require('dep'); require('./local');"
+                   " require('fs/promises'); require('missing')")
+        self.write('outer/local.js', "require('idx')")
+        self.write('outer/node_modules/dep/package.json', {'name': 'dep'})
+        self.write('outer/node_modules/dep/index.js', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, rel_path, content):
+        path = os.path.join(self.node_modules, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def path(self, rel_path):
+        return os.path.join(self.node_modules, rel_path)
+
+    def resolve(self, from_package, specifier, kind='require'):
+        return py_common.npm.resolve(self.path(from_package), specifier, kind)
+
+    def test_exports(self):
+        self.assertEqual(self.resolve('main', 'exp'), self.path('exp/cjs.js'))
+        self.assertEqual(self.resolve('main', 'exp', 'import'),
+                         self.path('exp/esm.mjs'))
+        self.assertEqual(self.resolve('main', 'exp/feat/x'),
+                         self.path('exp/lib/x.js'))
+        # The first matching condition wins, not the most specific.
+        self.assertEqual(self.resolve('main', 'exp/cond'),
+                         self.path('exp/d.js'))
+        # Files not listed in "exports" are not exposed.
+        self.assertEqual(self.resolve('main', 'exp/d.js'), None)
+
+    def test_imports(self):
+        self.assertEqual(self.resolve('exp/lib', '#dep'),
+                         self.path('exp/lib/dep.js'))
+        self.assertEqual(self.resolve('exp/lib', '#other'), None)
+
+    def test_main_and_index(self):
+        self.assertEqual(self.resolve('exp', 'main'),
+                         self.path('main/lib/main.js'))
+        self.assertEqual(self.resolve('exp', 'main/lib/other'),
+                         self.path('main/lib/other.js'))
+        self.assertEqual(self.resolve('exp', 'idx'), self.path('idx/index.js'))
+        self.assertEqual(self.resolve('main/lib', '../../idx'),
+                         self.path('idx/index.js'))
+
+    def test_nested_node_modules(self):
+        self.assertEqual(self.resolve('outer', 'dep'),
+                         self.path('outer/node_modules/dep/index.js'))
+        self.assertEqual(self.resolve('main', 'dep'), self.path('dep/index.js'))
+
+    def test_self_reference(self):
+        rq = py_common.npm._package_requires(
+            self.path('exp'), (self.path('exp/lib/self.js'),), set())
+        self.assertEqual(
+            rq['srcs'], (self.path('exp/lib/self.js'), self.path('exp/lib/x.js')))
+        self.assertEqual(rq['dep_entries'], ())
+        self.assertTrue(rq['upper'])
+
+    def test_dep_entries(self):
+        rq = py_common.npm._package_requires(self.path('outer'), None, set())
+        self.assertEqual(
+            rq['srcs'],
+            (self.path('outer/index.js'), self.path('outer/local.js')))
+        self.assertEqual(sorted(rq['dep_entries']), [
+            ('dep', self.path('outer/node_modules/dep'),
+             (self.path('outer/node_modules/dep/index.js'),)),
+            ('idx', self.path('idx'), (self.path('idx/index.js'),)),
+            ('missing', None, None),
+        ])
+        self.assertTrue(rq['upper'])
+
+if __name__ == '__main__':
+    unittest.main()
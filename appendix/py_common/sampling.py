@@ -0,0 +1,156 @@
+# Copyright 2017 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Approximate experiment runs that look at a random sample of modules
+and report confidence intervals instead of exact counts.
+"""
+
+import math
+import random
+
+# Two-sided z-scores for supported confidence levels.
+_Z_SCORES = {
+    0.90: 1.645,
+    0.95: 1.960,
+    0.99: 2.576,
+}
+
+def parse_argv(argv):
+    """
+    Separates sampling flags from an experiment's positional arguments.
+
+    Recognizes
+      --sample        examine modules in a random order until done
+      --seed=N        seed for the random number generator
+      --tolerance=T   stop once intervals are within +/- T (default 0.05)
+      --confidence=C  one of 0.90, 0.95 (default), 0.99
+
+    Returns (positional_args, sample) where sample is None when
+    --sample was not specified.
+    """
+    positional = []
+    options = {}
+    for arg in argv:
+        if arg.startswith('--'):
+            (key, _, value) = arg[2:].partition('=')
+            options[key] = value
+        else:
+            positional.append(arg)
+    unknown = set(options.keys()) - set(
+        ('sample', 'seed', 'tolerance', 'confidence'))
+    if unknown:
+        raise Exception('Unrecognized flags: %s' % ', '.join(sorted(unknown)))
+    if 'sample' not in options:
+        return (positional, None)
+    if options['sample']:
+        # Every file of a sampled module is examined.
+        raise Exception('--sample takes no value')
+    sample = Sample(
+        seed=int(options['seed']) if options.get('seed') else None,
+        tolerance=float(options.get('tolerance') or 0.05),
+        confidence=float(options.get('confidence') or 0.95))
+    return (positional, sample)
+
+class Sample(object):
+    """
+    Parameters for, and the random state of, an approximate run.
+    """
+
+    def __init__(self, seed=None, tolerance=0.05, confidence=0.95,
+                 min_modules=20):
+        if confidence not in _Z_SCORES:
+            raise Exception('unsupported confidence %r' % confidence)
+        self.tolerance = tolerance
+        self.confidence = confidence
+        self.z = _Z_SCORES[confidence]
+        self.min_modules = min_modules
+        self.rng = random.Random(seed)
+
+    def shuffled(self, module_names):
+        """
+        module_names in a random order so that any prefix is a simple
+        random sample.
+        """
+        module_names = list(module_names)
+        self.rng.shuffle(module_names)
+        return module_names
+
+    def proportion_interval(self, successes, trials):
+        """
+        The Wilson score interval for a binomial proportion.
+
+        Returns (low, high) as fractions in [0, 1].
+        """
+        if not trials:
+            return (0.0, 1.0)
+        z2 = self.z * self.z
+        p = float(successes) / trials
+        center = (p + z2 / (2 * trials)) / (1 + z2 / trials)
+        spread = (self.z / (1 + z2 / trials)) * math.sqrt(
+            p * (1 - p) / trials + z2 / (4 * trials * trials))
+        return (max(0.0, center - spread), min(1.0, center + spread))
+
+    def quantile_interval(self, sorted_values, q):
+        """
+        A distribution-free interval for the q-th quantile based on
+        order statistics.
+
+        Returns (low, high) values from sorted_values.
+        """
+        n = len(sorted_values)
+        if not n:
+            return (0, 0)
+        spread = self.z * math.sqrt(n * q * (1 - q))
+        lo = max(0, int(math.floor(n * q - spread)))
+        hi = min(n - 1, int(math.ceil(n * q + spread)))
+        return (sorted_values[lo], sorted_values[hi])
+
+    def converged(self, *counts):
+        """
+        True when enough modules have been examined that the interval for
+        each (successes, trials) pair in counts is within the tolerance.
+        """
+        for (successes, trials) in counts:
+            if trials < self.min_modules:
+                return False
+            (lo, hi) = self.proportion_interval(successes, trials)
+            if (hi - lo) / 2 > self.tolerance:
+                return False
+        return True
+
+    def describe(self, module_count, total_module_count):
+        """
+        Markdown noting that results are approximate.
+        """
+        return (
+            'Estimated from %d of %d modules with %d%% confidence'
+            ' intervals.' % (
+                module_count, total_module_count,
+                int(round(self.confidence * 100))))
+
+    def percentage_interval_text(self, successes, trials):
+        (lo, hi) = self.proportion_interval(successes, trials)
+        return '(CI %1.02f%% - %1.02f%%)' % (lo * 100, hi * 100)
+
+    def quartiles_text(self, sorted_values):
+        """
+        Like the "a / b / c" quartiles column with an interval for each.
+        """
+        parts = []
+        for q in (0.25, 0.5, 0.75):
+            value = sorted_values[int(len(sorted_values) * q)]
+            (lo, hi) = self.quantile_interval(sorted_values, q)
+            parts.append('%d [%d-%d]' % (value, lo, hi))
+        return ' / '.join(parts)
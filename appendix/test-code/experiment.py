@@ -16,7 +16,7 @@
 
 """Looks for test code patterns under node_modules.
 
-Patterns identify include
+Patterns identify include calls outside comments like
 
   * require('assert')
   * require('chai')
@@ -25,36 +25,94 @@ Patterns identify include
   * require('should')
   * require('unexpected')
 
+Each of the separate module trees has its own copy of shared
+dependencies, so results are cached by file content.
 """
 
+import hashlib
 import json
 import os.path
+import py_common.budget
 import py_common.npm
+import py_common.sampling
 import re
 import shutil
 import sys
 
 
-test_code_pattern = re.compile(
-    r'(?m)(?:^|[^.\w])require\s*[(]\s*[\'\"](?:assert|chai|chai/[^\'\"]|mocha|should|unexpected)[\'\"]')
+_TEST_MODULES = frozenset(('assert', 'chai', 'mocha', 'should', 'unexpected'))
+
+def is_test_module(specifier):
+    return specifier in _TEST_MODULES or specifier.startswith('chai/')
+
+def content_has_test_code(path, content):
+    """
+    True if the JS content of the file at path requires a test module.
+    """
+    for specifier in py_common.npm.required_modules(content):
+        if is_test_module(specifier):
+            return True
+    return False
+
+def has_test_code(module_root, budget, content_cache=None):
+    """
+    True if any JS file under module_root requires a test module.
+
+    Stops at the first such file.
+    content_cache maps file content hashes to earlier results, or to
+    None for content that ran out of budget, and is updated in place.
+    """
+    if content_cache is None:
+        content_cache = {}
+    for js_file in py_common.npm.js_files_under(module_root):
+        # Check the size before reading so that huge files are neither
+        # read nor hashed.
+        if not budget.admit(js_file):
+            continue
+        with open(js_file, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha1(content).digest()
+        if key not in content_cache:
+            (ok, found) = budget.run(js_file, content_has_test_code, content)
+            content_cache[key] = found if ok else None
+        elif content_cache[key] is None:
+            budget.skip(js_file, 'time')
+        if content_cache[key]:
+            return True
+    return False
 
 
 if __name__ == '__main__':
-    (node_modules, separate_modules, top100_txt) = sys.argv[1:]
+    (argv, budget) = py_common.budget.parse_argv(sys.argv[1:])
+    # Modules are examined on their own so there are no dependency
+    # edges to take from --package-lock.
+    (argv, _) = py_common.npm.parse_argv(argv)
+    (argv, sample) = py_common.sampling.parse_argv(argv)
+    (node_modules, separate_modules, top100_txt) = argv
 
-    top100 = [x for x in file(top100_txt).read().split('\n') if x]
+    top100 = [x for x in open(top100_txt).read().split('\n') if x]
 
     uses = 0
     total_count = 0
-    has_test_code = {}
-    for module_name in top100:
+    content_cache = {}
+    for module_name in (sample.shuffled(top100) if sample else top100):
+        budget.start_module(module_name)
         module_root = os.path.join(separate_modules, module_name)
-        for js_file in py_common.npm.js_files_under(module_root):
-            js_content = file(js_file, 'r').read()
-            if test_code_pattern.search(js_content):
-                uses += 1
-                break
+        if has_test_code(module_root, budget, content_cache):
+            uses += 1
         total_count += 1
+        if sample and sample.converged((uses, total_count)):
+            break
+
+    budget.close()
+
+    interval = ''
+    note = ''
+    if sample is not None:
+        interval = ' ' + sample.percentage_interval_text(uses, total_count)
+        note = '\n\n' + sample.describe(total_count, len(top100))
+    if budget.skipped:
+        note += '\n\n' + budget.summary()
 
     print (
 """
@@ -64,5 +122,5 @@ Some of the top 100 modules are test code, e.g. mocha, chai.
 This measures which modules, when installed `--only=prod` include
 test patterns.
 
-%d of %d = %1.02f%% contain test code patterns
-""" % (uses, total_count, (100.0 * uses) / total_count))
+%d of %d = %1.02f%%%s contain test code patterns%s
+""" % (uses, total_count, (100.0 * uses) / total_count, interval, note))
@@ -22,16 +22,33 @@ following keys under "scripts" in package.json:
   * preinstall
   * install
   * postinstall
+
+or a binding.gyp file, for which npm runs "node-gyp rebuild" as an
+implicit install script.  This is the rule behind the lockfile's
+"hasInstallScript" so results do not depend on the lockfile version.
+
+Each installed copy of a package counts, including scoped ones and
+ones nested under other packages' node_modules.
+
+With --package-lock=path/to/package-lock.json, packages are enumerated
+from the lockfile instead of by listing directories.  Only prod
+packages that are installed under node_modules are counted, and their
+package.json files are only read when the lockfile does not record
+whether a package has install scripts.
 """
 
 import json
 import os.path
+import py_common.budget
 import py_common.npm
+import py_common.sampling
 import sys
 
 def uses_scripts(package_root):
-    package_json = json.loads(
-        file(os.path.join(package_root, 'package.json')).read())
+    if os.path.isfile(os.path.join(package_root, 'binding.gyp')):
+        return True
+    with open(os.path.join(package_root, 'package.json'), 'rb') as f:
+        package_json = json.loads(f.read().decode('utf-8'))
     scripts_obj = package_json.get('scripts', None)
     if scripts_obj is None:
         return False
@@ -40,14 +57,47 @@ def uses_scripts(package_root):
         if script_type in scripts_obj: return True
     return False
 
+def uses_scripts_per_locked_package(package_lock, node_modules):
+    """
+    Maps install paths of prod packages in package_lock that are
+    installed under node_modules to whether they use installation
+    scripts.
+    """
+    project_root = os.path.dirname(os.path.abspath(node_modules))
+    result = {}
+    for (install_path, locked) in package_lock['packages'].items():
+        if locked['dev'] or locked['dev_optional']:
+            continue
+        package_root = os.path.join(project_root, install_path)
+        if not os.path.isfile(os.path.join(package_root, 'package.json')):
+            continue  # Not installed, e.g. an optional dependency
+        uses = locked['has_install_script']
+        if uses is None:
+            uses = uses_scripts(package_root)
+        result[install_path] = uses
+    return result
+
 if __name__ == '__main__':
-    (node_modules, separate_modules, top100_txt) = sys.argv[1:]
+    # Budget and sampling flags are accepted for uniformity with the
+    # other experiments but every package.json is read.
+    (argv, _) = py_common.budget.parse_argv(sys.argv[1:])
+    (argv, package_lock) = py_common.npm.parse_argv(argv)
+    (argv, _) = py_common.sampling.parse_argv(argv)
+    (node_modules, separate_modules, top100_txt) = argv
 
-    per_package = py_common.npm.for_each_npm_package(
-        node_modules, uses_scripts)
+    if package_lock is None:
+        per_package = py_common.npm.for_each_npm_package(
+            node_modules, uses_scripts)
+    else:
+        per_package = uses_scripts_per_locked_package(
+            package_lock, node_modules)
+        if not per_package:
+            raise Exception(
+                'no prod package from --package-lock is installed under %s'
+                % node_modules)
     total_count = 0
     uses_scripts = 0
-    for uses in per_package.itervalues():
+    for uses in per_package.values():
         if uses:
             uses_scripts += 1
         total_count += 1
@@ -46,6 +46,7 @@ class Lexer(object):
 
     def __init__(self, states, first):
         self.regexes = {}
+        self.byte_regexes = {}
         self.toks = {}
 
         for state, rules in states.items():
@@ -54,19 +55,28 @@ class Lexer(object):
                 groupid = "t%d" % tok.id
                 self.toks[groupid] = tok
                 parts.append("(?P<%s>%s)" % (groupid, tok.regex))
-            self.regexes[state] = re.compile("|".join(parts), re.MULTILINE|re.VERBOSE)
+            pattern = "|".join(parts)
+            self.regexes[state] = re.compile(pattern, re.MULTILINE|re.VERBOSE)
+            # Python 3 will not match a str pattern against bytes.
+            self.byte_regexes[state] = re.compile(
+                pattern.encode('ascii'), re.MULTILINE|re.VERBOSE)
 
         self.state = first
 
     def lex(self, text):
         """Lexically analyze `text`.
 
+        `text` may be `str` or `bytes`, and token texts have the same type.
+
         Yields pairs (`name`, `tokentext`).
 
         """
         end = len(text)
         state = self.state
-        regexes = self.regexes
+        if isinstance(text, bytes):
+            regexes = self.byte_regexes
+        else:
+            regexes = self.regexes
         toks = self.toks
         start = 0
 